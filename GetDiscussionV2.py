@@ -1,9 +1,12 @@
 import requests
-from flask import jsonify, current_app
+from flask import jsonify, current_app, request
 from bs4 import BeautifulSoup
 import re
 import os
+import time
+import hashlib
 import constants
+from idmap import ID_MAP
 from urllib.parse import urljoin
 
 CLIENT_ID = os.getenv('CLIENT_ID')
@@ -17,18 +20,38 @@ def fetch_season_tree(search_term):
     # AniList returns {"data": null, "errors": [...]} on error, so guard against None.
     return (res.json().get('data') or {}).get('Media')
 
+# The in-process caches below map key -> (stored_at, value), with stored_at a wall-clock time
+# so entries keep their age across snapshot/restore. Expired entries are dropped on lookup.
+def _cache_get(cache, key, ttl):
+    entry = cache.get(key)
+    if entry is None:
+        return None
+    stored_at, value = entry
+    if time.time() - stored_at > ttl:
+        cache.pop(key, None)
+        return None
+    return value
+
+def _cache_put(cache, key, value, cache_max):
+    if len(cache) >= cache_max:
+        cache.clear()
+    cache[key] = (time.time(), value)
+
 # Small in-process cache so repeated chain walks (and repeat requests for popular shows)
-# don't re-hit AniList for the same node. Bounded to avoid unbounded growth on a long-lived dyno.
+# don't re-hit AniList for the same node. Bounded to avoid unbounded growth on a long-lived dyno,
+# and expiring so airing shows pick up new episode counts / nextAiringEpisode.
 _NODE_CACHE = {}
 _NODE_CACHE_MAX = 512
+_NODE_CACHE_TTL = 6 * 3600
 
 def fetch_node_relations(anilist_id):
     """Fetch a single Media's immediate relations by AniList id, for stepping along a
     franchise chain when the nested season tree runs out of depth. Returns None on failure."""
     if not anilist_id:
         return None
-    if anilist_id in _NODE_CACHE:
-        return _NODE_CACHE[anilist_id]
+    cached = _cache_get(_NODE_CACHE, anilist_id, _NODE_CACHE_TTL)
+    if cached is not None:
+        return cached
     try:
         res = requests.post(constants.ANILIST_API_URL, json={'query': constants.GRAPHQL_NODE_QUERY, 'variables': {'id': anilist_id}}, timeout=10)
         node = (res.json().get('data') or {}).get('Media')
@@ -36,9 +59,7 @@ def fetch_node_relations(anilist_id):
         current_app.logger.error(f"AniList node fetch failed for id {anilist_id}: {e}")
         return None
     if node:
-        if len(_NODE_CACHE) >= _NODE_CACHE_MAX:
-            _NODE_CACHE.clear()
-        _NODE_CACHE[anilist_id] = node
+        _cache_put(_NODE_CACHE, anilist_id, node, _NODE_CACHE_MAX)
     return node
 
 def _normalize_title(title):
@@ -124,6 +145,23 @@ def calculate_global_offset(season_node):
 # 2. RESOLVERS & FALLBACKS
 # ---------------------------------------------------------
 
+def _ordinal(n):
+    n = int(n)
+    suffix = 'th' if 10 <= n % 100 <= 20 else {1: 'st', 2: 'nd', 3: 'rd'}.get(n % 10, 'th')
+    return f"{n}{suffix}"
+
+def offline_mal_search(anime_query, season):
+    """Title -> MAL id from the offline cross-reference dataset, trying the common ways a
+    season is written in titles ("X Season 2", "X 2nd Season", "X 2"). No network calls."""
+    season_str = str(season).strip()
+    if not season_str.isdigit() or int(season_str) <= 1:
+        return ID_MAP.mal_id_for_title(anime_query)
+    for candidate in (f"{anime_query} Season {season_str}", f"{anime_query} {_ordinal(season_str)} Season", f"{anime_query} {season_str}"):
+        mal_id = ID_MAP.mal_id_for_title(candidate)
+        if mal_id:
+            return mal_id
+    return None
+
 def fallback_mal_search(anime_query, season):
     if not anime_query:
         return None
@@ -133,7 +171,12 @@ def fallback_mal_search(anime_query, season):
         search_term = anime_query
     else:
         search_term = f"{anime_query} Season {season}"
-        
+
+    # The offline dataset is exact where it has the title; only go live for titles it lacks.
+    mal_id = offline_mal_search(anime_query, season)
+    if mal_id:
+        return mal_id
+
     try:
         url = constants.MAL_ANIME_URL
         params = {'q': search_term, 'limit': 1}
@@ -148,7 +191,31 @@ def fallback_mal_search(anime_query, season):
         
     return None
 
+# Resolved (mal_id, local_ep, slug) per request, keyed by "<query>|<season>|<episode>". Only
+# confident resolutions are kept (see _resolve_with_split_cour); misses and guesses are retried
+# so they can improve once AniList/MAL catch up.
+_RESOLVED_CACHE = {}
+_RESOLVED_CACHE_MAX = 2048
+_RESOLVED_CACHE_TTL = 6 * 3600
+
+def resolve_mal_id(anime_query, season, episode):
+    """Cached front for resolve_mal_id_with_split_cour."""
+    key = f"{_normalize_title(anime_query)}|{str(season).strip().lower()}|{int(episode)}"
+    cached = _cache_get(_RESOLVED_CACHE, key, _RESOLVED_CACHE_TTL)
+    if cached is not None:
+        return cached
+    mal_id, local_ep, slug, confident = _resolve_with_split_cour(anime_query, season, episode)
+    if mal_id and confident:
+        _cache_put(_RESOLVED_CACHE, key, (mal_id, local_ep, slug), _RESOLVED_CACHE_MAX)
+    return mal_id, local_ep, slug
+
 def resolve_mal_id_with_split_cour(anime_query, season, episode):
+    return _resolve_with_split_cour(anime_query, season, episode)[:3]
+
+def _resolve_with_split_cour(anime_query, season, episode):
+    """Returns (mal_id, local_ep, slug, confident). Confident means the id came from an AniList
+    node (its idMal or the offline map) and every episode count on the way was known, rather
+    than from a MAL title search or the 999 placeholder for a count AniList doesn't have."""
     target_ep = int(episode)
     season_str = str(season).strip()
     
@@ -164,7 +231,7 @@ def resolve_mal_id_with_split_cour(anime_query, season, episode):
     current_node = fetch_season_tree(search_term)
     
     if not current_node:
-        return fallback_mal_search(anime_query, season), target_ep, search_term.replace(' ', '_')
+        return fallback_mal_search(anime_query, season), target_ep, search_term.replace(' ', '_'), False
 
     # Crunchyroll usually numbers an episode locally to the season being watched (continuous
     # across that season's cours), but sometimes sends the franchise-wide (global) number with
@@ -183,6 +250,7 @@ def resolve_mal_id_with_split_cour(anime_query, season, episode):
             current_app.logger.info(f"Episode {target_ep} within season span {season_span}; treating as LOCAL.")
 
     accumulated_eps = 0
+    counts_known = True
     
     # 3. Walk forward ONLY from the start of the requested season (handling split cours)
     while current_node:
@@ -190,9 +258,11 @@ def resolve_mal_id_with_split_cour(anime_query, season, episode):
         fmt = current_node.get('format')
         
         ep_count = current_node.get('episodes')
+        count_guessed = False
         if not ep_count:
             next_airing = current_node.get('nextAiringEpisode')
             ep_count = (next_airing.get('episode', 2) - 1) if next_airing else 999
+            count_guessed = next_airing is None
             
         title_node = current_node.get('title', {})
         title = title_node.get('romaji') or title_node.get('english') or search_term
@@ -202,14 +272,20 @@ def resolve_mal_id_with_split_cour(anime_query, season, episode):
         if fmt in [constants.FORMAT_MOVIE, constants.FORMAT_OVA, constants.FORMAT_SPECIAL] and season_str not in ['0', 'movie', 'ova', 'special']:
             pass 
         else:
+            counts_known = counts_known and not count_guessed
             # Check if the requested episode falls in this part of the split-cour
             if target_ep <= (accumulated_eps + ep_count):
                 local_ep = target_ep - accumulated_eps
                 
+                confident = counts_known
+                if not mal_id:
+                    # The node's own title is already season-specific, so look it up as-is.
+                    mal_id = ID_MAP.mal_id_for_anilist(current_node.get('id')) or ID_MAP.mal_id_for_title(title)
                 if not mal_id:
                     mal_id = fallback_mal_search(title, season)
+                    confident = False
                     
-                return mal_id, local_ep, slug
+                return mal_id, local_ep, slug, confident
             
             accumulated_eps += ep_count
             
@@ -224,33 +300,59 @@ def resolve_mal_id_with_split_cour(anime_query, season, episode):
         current_node = next_node
 
     # If math fails entirely, return the base search and hope for the best
-    return fallback_mal_search(anime_query, season), target_ep, search_term.replace(' ', '_')
+    return fallback_mal_search(anime_query, season), target_ep, search_term.replace(' ', '_'), False
 
 # ---------------------------------------------------------
 # 3. SCRAPERS & FORUM SEARCH
 # ---------------------------------------------------------
 
+# Parsed MAL episode-list pages, keyed by "<mal_id>:<offset>" -> {row index: topic id}. One page
+# covers 100 episodes, so a single scrape answers every later request for that block.
+_EPISODE_PAGE_CACHE = {}
+_EPISODE_PAGE_CACHE_MAX = 512
+_EPISODE_PAGE_CACHE_TTL = 24 * 3600
+
+def fetch_episode_page(anime, id, offset):
+    """Scrape one MAL episode-list page into {row index: discussion topic id}. Rows without a
+    discussion link are left out. Returns None when the page has no episode table."""
+    BASE_URL = f'https://myanimelist.net/anime/{id}/{anime}/episode?offset={offset}'
+
+    response = requests.get(BASE_URL, timeout=10)
+    soup = BeautifulSoup(response.content, 'html.parser')
+    table = soup.find('table',  {'class': 'episode_list'})
+
+    if table is None: return None
+
+    topics = {}
+    rows = table.find_all('tr')
+    for idx in range(1, len(rows)):
+        anchor = rows[idx].find_all(['td', 'th'])[-1].find('a')
+        if anchor is None or not anchor.get('href'):
+            continue
+        # --- NEW: Strict Regex Extraction ---
+        match = re.search(r'topicid=(\d+)', anchor['href'])
+        if match:
+            topics[idx] = match.group(1)
+    return topics
+
 def get_discussion_link(anime, id, episode):
     try:
         episode = int(episode)
         offset = ((episode-1)//100)*100 if episode > 100 else 0
-        BASE_URL = f'https://myanimelist.net/anime/{id}/{anime}/episode?offset={offset}'
-        
-        response = requests.get(BASE_URL, timeout=10)
-        soup = BeautifulSoup(response.content, 'html.parser')
-        table = soup.find('table',  {'class': 'episode_list'})
+        remainder = (episode % 100)
+        idx = 100 if remainder == 0 else remainder
 
-        if table is None: return None
+        key = f"{id}:{offset}"
+        topics = _cache_get(_EPISODE_PAGE_CACHE, key, _EPISODE_PAGE_CACHE_TTL)
+        # A missing row usually means the episode aired after the page was cached, so re-scrape.
+        if topics is None or idx not in topics:
+            topics = fetch_episode_page(anime, id, offset)
+            if topics is None:
+                return None
+            _cache_put(_EPISODE_PAGE_CACHE, key, topics, _EPISODE_PAGE_CACHE_MAX)
+
+        return topics.get(idx)
 
-        remainder = (episode % 100)
-        idx = 100 if remainder == 0 else remainder 
-        row = table.find_all('tr')[idx]
-        link = row.find_all(['td', 'th'])[-1].find('a')['href']
-        
-        # --- NEW: Strict Regex Extraction ---
-        match = re.search(r'topicid=(\d+)', link)
-        return match.group(1) if match else None
-        
     except Exception as e:
         current_app.logger.error(f"Scraper failed for {anime}-{episode}: {e}")
         return None
@@ -278,9 +380,15 @@ def normalize_text(value):
         return ""
     return re.sub(r'\s+', ' ', value).strip()
 
-def scrape_forum_topic_html(discussion_id):
+def scrape_forum_topic_html(discussion_id, offset=0):
+    """Scrape the forum page holding post `offset` + 1. MAL pages hold MAL_FORUM_PAGE_SIZE posts
+    and are addressed by `show`, so the page start is rounded down and posts are numbered from
+    it, matching the numbers the MAL API would give them."""
     try:
+        page_start = (offset // constants.MAL_FORUM_PAGE_SIZE) * constants.MAL_FORUM_PAGE_SIZE
         topic_url = f"https://myanimelist.net/forum/?topicid={discussion_id}"
+        if page_start:
+            topic_url += f"&show={page_start}"
         response = requests.get(topic_url, timeout=10)
         response.raise_for_status()
 
@@ -339,7 +447,7 @@ def scrape_forum_topic_html(discussion_id):
 
             posts.append({
                 'id': post_anchor,
-                'number': len(posts) + 1,
+                'number': page_start + len(posts) + 1,
                 'created_at': created_at,
                 'created_by': {
                     'name': username,
@@ -364,13 +472,57 @@ def scrape_forum_topic_html(discussion_id):
         current_app.logger.error(f"Forum HTML scrape failed for topic {discussion_id}: {e}")
         return None
 
+def fetch_forum_topic(discussion_id, offset=0):
+    """Fetch up to 100 posts of a forum topic starting at `offset`. Returns (topic, error):
+    the structured MAL API topic when allowed, else the scraped HTML page holding `offset`
+    (which may also include earlier posts) when MAL forbids API access; topic is None and
+    error holds MAL's payload on failure."""
+    mal_forum_url = f"https://api.myanimelist.net/v2/forum/topic/{discussion_id}?limit=100&offset={offset}"
+    response = requests.get(mal_forum_url, headers={'X-MAL-CLIENT-ID': CLIENT_ID}, timeout=10)
+
+    # Prefer the structured API response when MAL allows it.
+    mal_data = response.json()
+    if 'error' in mal_data:
+        current_app.logger.error(f"MAL API Error: {mal_data}")
+        error_payload = mal_data.get('error', {})
+        error_code = error_payload.get('error') if isinstance(error_payload, dict) else error_payload
+        if error_code == 'forbidden':
+            current_app.logger.info(f"Falling back to HTML forum scrape for topic {discussion_id}")
+            scraped_topic = scrape_forum_topic_html(discussion_id, offset)
+            if scraped_topic:
+                return scraped_topic, None
+        return None, mal_data
+
+    return mal_data.get('data', {}), None
+
 # ---------------------------------------------------------
 # 4. MAIN ENDPOINT
 # ---------------------------------------------------------
 
-def get_discussion(anime_query, season, episode):
+def project_topic(topic, fields=None, max_body_chars=None):
+    """Trim a topic's posts for list views: keep only the post keys in `fields` (e.g.
+    id, number, created_by, body) and cut bodies to `max_body_chars`. Topic-level keys are kept."""
+    if not fields and max_body_chars is None:
+        return topic
+    posts = []
+    for post in topic.get('posts', []):
+        if fields:
+            post = {key: value for key, value in post.items() if key in fields}
+        if max_body_chars is not None and isinstance(post.get('body'), str):
+            post = {**post, 'body': post['body'][:max_body_chars]}
+        posts.append(post)
+    return {**topic, 'posts': posts}
+
+def topic_etag(discussion_id, topic, fields=None, max_body_chars=None):
+    """Strong ETag from the topic id and its post high-water mark, plus the projection, since
+    each projection is a different representation of the same thread."""
+    high_water = max((post.get('number', 0) for post in topic.get('posts', [])), default=0)
+    key = f"{discussion_id}:{high_water}:{','.join(sorted(fields or []))}:{max_body_chars}"
+    return hashlib.sha1(key.encode('utf-8')).hexdigest()
+
+def get_discussion(anime_query, season, episode, fields=None, max_body_chars=None):
     # Use our hybrid split-cour resolver
-    mal_id, local_ep, anime_slug = resolve_mal_id_with_split_cour(anime_query, season, episode)
+    mal_id, local_ep, anime_slug = resolve_mal_id(anime_query, season, episode)
 
     if not mal_id:
         return jsonify(message=constants.MESSAGE_MAL_ID_NOT_FOUND)
@@ -387,21 +539,11 @@ def get_discussion(anime_query, season, episode):
     if not discussion_id:
         return jsonify(message=constants.MESSAGE_DISCUSSION_NOT_FOUND)
 
-    # Fetch the forum posts
-    mal_forum_url = f"https://api.myanimelist.net/v2/forum/topic/{discussion_id}?limit=100"
-    response = requests.get(mal_forum_url, headers={'X-MAL-CLIENT-ID': CLIENT_ID}, timeout=10)
-    
-    # Prefer the structured API response when MAL allows it.
-    mal_data = response.json()
-    if 'error' in mal_data:
-        current_app.logger.error(f"MAL API Error: {mal_data}")
-        error_payload = mal_data.get('error', {})
-        error_code = error_payload.get('error') if isinstance(error_payload, dict) else error_payload
-        if error_code == 'forbidden':
-            current_app.logger.info(f"Falling back to HTML forum scrape for topic {discussion_id}")
-            scraped_topic = scrape_forum_topic_html(discussion_id)
-            if scraped_topic:
-                return jsonify(message=scraped_topic)
-        return jsonify(error=mal_data, message="MAL API rejected the discussion ID.")
-        
-    return jsonify(message=mal_data.get('data', {}))
+    topic, error = fetch_forum_topic(discussion_id)
+    if topic is None:
+        return jsonify(error=error, message="MAL API rejected the discussion ID.")
+
+    response = jsonify(message=project_topic(topic, fields, max_body_chars))
+    response.set_etag(topic_etag(discussion_id, topic, fields, max_body_chars))
+    # Answers GET/HEAD with 304 when If-None-Match still matches; POSTs always get the body.
+    return response.make_conditional(request)
@@ -1,20 +1,86 @@
+import atexit
 from flask import Flask, jsonify, current_app
 from GetDiscussionV2 import get_discussion
 from flask_cors import CORS
-from flask import request
+from flask import request, Response
+import constants
+import snapshot
+from idmap import ID_MAP
+import watch
+from compression import compress_response
 app = Flask(__name__)
 CORS(app)
+
+# Warm the caches from the last snapshot before serving, and keep the snapshot fresh.
+app.logger.info(f"Loaded {snapshot.load_snapshot()} cached entries from {snapshot.describe_location()}")
+snapshot.start_snapshot_timer(logger=app.logger)
+
+# Index the offline id dataset before serving; later changes are picked up in the background.
+try:
+    ID_MAP.refresh()
+except Exception as e:
+    app.logger.error(f"Id map load failed: {e}")
+ID_MAP.start_refresh_timer(logger=app.logger)
+
+def _save_snapshot_on_exit():
+    try:
+        snapshot.save_snapshot()
+    except Exception as e:
+        app.logger.error(f"Cache snapshot on shutdown failed: {e}")
+atexit.register(_save_snapshot_on_exit)
 @app.route('/')
 def home():
     return jsonify(message="Hello from AniNex!")
-@app.route('/discussion', methods=['POST'])
+@app.after_request
+def compressResponse(response):
+    return compress_response(response, request)
+
+def _parse_fields(value):
+    """`fields` as a JSON list or a comma-separated string, e.g. "id,created_by,body". Any
+    other type is ignored."""
+    if not value:
+        return None
+    if isinstance(value, str):
+        value = value.split(',')
+    elif not isinstance(value, list):
+        return None
+    return {str(field).strip() for field in value if str(field).strip()} or None
+
+def _parse_max_body_chars(value):
+    value = str(value).strip() if value is not None else ''
+    return int(value) if value.isdigit() else None
+
+@app.route('/discussion', methods=['GET', 'POST'])
 def getDiscussionPayload():
-    data = request.get_json()
-    current_app.logger.info(f"POST Discussion for {data}")
+    # GET/HEAD take the same fields as query parameters, so clients can revalidate with If-None-Match.
+    data = request.args if request.method in ('GET', 'HEAD') else request.get_json()
+    current_app.logger.info(f"{request.method} Discussion for {dict(data)}")
     anime = data.get('anime')
     season = data.get('season')
     episode = data.get('episode')
-    return get_discussion(anime_query=anime, season=season, episode=episode)
+    fields = _parse_fields(data.get('fields'))
+    max_body_chars = _parse_max_body_chars(data.get('max_body_chars'))
+    return get_discussion(anime_query=anime, season=season, episode=episode, fields=fields, max_body_chars=max_body_chars)
+
+@app.route('/watch/<int:topic_id>')
+def watchTopic(topic_id):
+    # Resume after the last post the client saw: EventSource sends Last-Event-ID on reconnect.
+    last_seen = request.headers.get('Last-Event-ID') or request.args.get('since') or '0'
+    last_seen = int(last_seen) if last_seen.isdigit() else 0
+    current_app.logger.info(f"WATCH topic {topic_id} since post {last_seen}")
+    poller, q, error = watch.subscribe(current_app._get_current_object(), topic_id, last_seen)
+    if error == watch.WATCH_NOT_FOUND:
+        return jsonify(message=constants.MESSAGE_DISCUSSION_NOT_FOUND), error
+    if error == watch.WATCH_LIMIT_REACHED:
+        return jsonify(message=constants.MESSAGE_WATCH_LIMIT_REACHED), error
+    response = Response(
+        watch.stream_topic(q),
+        mimetype='text/event-stream',
+        headers={'Cache-Control': 'no-cache', 'X-Accel-Buffering': 'no'},
+    )
+    # Runs even if the client disconnects before the stream starts.
+    response.call_on_close(lambda: poller.unsubscribe(q))
+    return response
 
 if __name__ == '__main__':
     app.run(debug=True)
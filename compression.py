@@ -0,0 +1,52 @@
+# compression.py
+#
+# gzip/brotli response compression, applied to every JSON/text response from an
+# after_request hook. Brotli is used when the package is installed and the client accepts it.
+
+import gzip
+
+try:
+    import brotli
+except ImportError:
+    brotli = None
+
+# Bodies smaller than this aren't worth the CPU or the Content-Encoding header.
+COMPRESS_MIN_SIZE = 500
+COMPRESS_MIMETYPES = {'application/json', 'text/html', 'text/plain'}
+
+def _pick_encoding(accept_encodings):
+    offered = ['br', 'gzip'] if brotli else ['gzip']
+    return accept_encodings.best_match(offered)
+
+def compress_response(response, request):
+    """Compress `response` in place for the encodings `request` accepts. Streamed responses
+    (e.g. Server-Sent Events) are left alone. A compressed body gets a weak ETag, since its
+    bytes differ from the identity representation the strong ETag was computed for."""
+    if response.direct_passthrough or response.is_streamed:
+        return response
+    response.vary.add('Accept-Encoding')
+
+    encoding = _pick_encoding(request.accept_encodings)
+    if encoding is None or 'Content-Encoding' in response.headers:
+        return response
+
+    etag, weak = response.get_etag()
+    if response.status_code == 304:
+        if etag and not weak:
+            response.set_etag(etag, weak=True)
+        return response
+    if response.mimetype not in COMPRESS_MIMETYPES or response.status_code < 200 or response.status_code == 204:
+        return response
+
+    data = response.get_data()
+    if len(data) < COMPRESS_MIN_SIZE:
+        return response
+
+    if encoding == 'br':
+        response.set_data(brotli.compress(data, quality=5))
+    else:
+        response.set_data(gzip.compress(data, compresslevel=6))
+    response.headers['Content-Encoding'] = encoding
+    if etag and not weak:
+        response.set_etag(etag, weak=True)
+    return response
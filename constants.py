@@ -82,6 +82,8 @@ GRAPHQL_NODE_QUERY = """
 MAL_API_URL = "https://api.myanimelist.net/v2"
 MAL_ANIME_URL = f"{MAL_API_URL}/anime"
 MAL_FORUM_URL = f"{MAL_API_URL}/forum/topics"
+# Posts per page on the HTML forum (pages are addressed with ?show=<first post offset>).
+MAL_FORUM_PAGE_SIZE = 50
 
 RELATION_TYPE_PREQUEL = 'PREQUEL'
 RELATION_TYPE_SEQUEL = 'SEQUEL'
@@ -92,3 +94,4 @@ FORMAT_SPECIAL = 'SPECIAL'
 
 MESSAGE_MAL_ID_NOT_FOUND = "Could not find a matching MAL ID for this season."
 MESSAGE_DISCUSSION_NOT_FOUND = "Discussion thread not found on MAL. The episode may not have aired yet."
+MESSAGE_WATCH_LIMIT_REACHED = "Too many live threads are being watched right now. Please try again later."
@@ -0,0 +1,209 @@
+# idmap.py
+#
+# Offline AniList <-> MAL id cross-reference, so id resolution and title lookup don't need a
+# live (slow, often wrong) MAL search. Loaded from the files listed in ID_MAP_PATH, which may be:
+#   - the anime-offline-database JSON ({"data": [{"sources": [...], "title", "synonyms"}]}), or
+#   - JSON Lines, one record per line, either in that shape or as
+#     {"anilist_id": 1, "mal_id": 1, "title": "...", "synonyms": ["..."]}.
+# JSON Lines files are append-only update logs: only lines added since the last read are parsed.
+# A later record replaces an earlier one for the same AniList id, title and reverse entries included.
+
+import json
+import os
+import re
+import threading
+import time
+
+ID_MAP_PATHS = [p.strip() for p in os.getenv('ID_MAP_PATH', '').split(',') if p.strip()]
+# Seconds between background checks of the dataset files for changes.
+ID_MAP_REFRESH_INTERVAL = 60
+
+_SOURCE_PATTERNS = {
+    'anilist_id': re.compile(r'anilist\.co/anime/(\d+)'),
+    'mal_id': re.compile(r'myanimelist\.net/anime/(\d+)'),
+}
+
+def normalize_title(title):
+    """Case- and punctuation-insensitive key for title lookups."""
+    return re.sub(r'[^a-z0-9]+', ' ', (title or '').lower()).strip()
+
+def _parse_record(entry):
+    """Pull (anilist_id, mal_id, titles) out of either supported record shape. Non-string
+    sources and titles are ignored; ids that aren't integers raise ValueError/TypeError."""
+    ids = {'anilist_id': entry.get('anilist_id'), 'mal_id': entry.get('mal_id')}
+    sources = entry.get('sources')
+    for source in sources if isinstance(sources, list) else []:
+        if not isinstance(source, str):
+            continue
+        for field, pattern in _SOURCE_PATTERNS.items():
+            match = pattern.search(source)
+            if match and not ids[field]:
+                ids[field] = match.group(1)
+    synonyms = entry.get('synonyms')
+    titles = [entry.get('title')] + (synonyms if isinstance(synonyms, list) else [])
+    anilist_id = int(ids['anilist_id']) if ids['anilist_id'] else None
+    mal_id = int(ids['mal_id']) if ids['mal_id'] else None
+    return anilist_id, mal_id, [t for t in titles if t and isinstance(t, str)]
+
+class IdMap:
+    """In-memory indexes over the cross-reference dataset: AniList id -> MAL id, MAL id ->
+    AniList id and normalized title -> MAL id. Titles shared by several MAL entries are
+    treated as unknown rather than guessed."""
+
+    def __init__(self, paths):
+        self.paths = paths
+        self.lock = threading.Lock()
+        self._reset()
+
+    def _reset(self):
+        self.mal_by_anilist = {}
+        self.anilist_by_mal = {}
+        self.mal_by_title = {}
+        # normalized title -> {mal_id: records listing it}; a title is in mal_by_title only
+        # while exactly one MAL id claims it.
+        self._title_claims = {}
+        # record key -> (anilist_id, mal_id, title keys), so a later record can replace it
+        self._records = {}
+        # path -> (mtime, inode, bytes consumed)
+        self._file_state = {}
+
+    def _claim(self, key, mal_id, delta):
+        claims = self._title_claims.setdefault(key, {})
+        count = claims.get(mal_id, 0) + delta
+        if count > 0:
+            claims[mal_id] = count
+        else:
+            claims.pop(mal_id, None)
+        if len(claims) == 1:
+            self.mal_by_title[key] = next(iter(claims))
+        else:
+            self.mal_by_title.pop(key, None)
+            if not claims:
+                del self._title_claims[key]
+
+    def _remove(self, record_key):
+        old = self._records.pop(record_key, None)
+        if old is None:
+            return
+        anilist_id, mal_id, keys = old
+        if anilist_id:
+            self.mal_by_anilist.pop(anilist_id, None)
+            if self.anilist_by_mal.get(mal_id) == anilist_id:
+                del self.anilist_by_mal[mal_id]
+        for key in keys:
+            self._claim(key, mal_id, -1)
+
+    def add(self, anilist_id, mal_id, titles=()):
+        """Index one record, replacing any earlier record for the same AniList id (or, for
+        records without one, the same MAL id) along with its reverse and title entries."""
+        if not mal_id:
+            return
+        record_key = ('anilist', anilist_id) if anilist_id else ('mal', mal_id)
+        self._remove(record_key)
+        keys = {normalize_title(title) for title in titles} - {''}
+        self._records[record_key] = (anilist_id, mal_id, keys)
+        if anilist_id:
+            self.mal_by_anilist[anilist_id] = mal_id
+            self.anilist_by_mal[mal_id] = anilist_id
+        for key in keys:
+            self._claim(key, mal_id, 1)
+
+    def _add_entry(self, entry):
+        """Index one raw record. Malformed records (wrong types, non-numeric ids) are skipped
+        so they can't stop the rest of the file from loading."""
+        if not isinstance(entry, dict):
+            return
+        try:
+            anilist_id, mal_id, titles = _parse_record(entry)
+        except (ValueError, TypeError, AttributeError):
+            return
+        self.add(anilist_id, mal_id, titles)
+
+    def _read(self, path, start):
+        """Index `path` from byte `start`, returning how many bytes were consumed."""
+        with open(path, 'rb') as f:
+            f.seek(start)
+            raw = f.read()
+        if not path.endswith('.jsonl'):
+            for entry in json.loads(raw).get('data', []):
+                self._add_entry(entry)
+            return start + len(raw)
+        # Stop at the last complete line; a partially appended record is picked up next time.
+        complete = raw[:raw.rfind(b'\n') + 1]
+        for line in complete.splitlines():
+            try:
+                self._add_entry(json.loads(line))
+            except ValueError:
+                continue
+        return start + len(complete)
+
+    def _load(self, stats):
+        """Index every file in `stats` (path -> os.stat result) that changed since it was read."""
+        for path, st in stats.items():
+            state = self._file_state.get(path)
+            if state is not None and st.st_mtime == state[0]:
+                continue
+            start = state[2] if state is not None else 0
+            try:
+                consumed = self._read(path, start)
+            except (OSError, ValueError, AttributeError):
+                continue
+            self._file_state[path] = (st.st_mtime, st.st_ino, consumed)
+
+    def refresh(self):
+        """Pick up dataset changes. Appended JSON Lines are indexed in place; a rewritten,
+        truncated or replaced file rebuilds every index on the side and swaps them in, so
+        lookups (which don't take the lock) never see a half-built index."""
+        stats = {}
+        for path in self.paths:
+            try:
+                stats[path] = os.stat(path)
+            except OSError:
+                continue
+
+        with self.lock:
+            rebuild = False
+            for path, st in stats.items():
+                state = self._file_state.get(path)
+                if state is None or st.st_mtime == state[0]:
+                    continue
+                if not path.endswith('.jsonl') or st.st_ino != state[1] or st.st_size < state[2]:
+                    rebuild = True
+
+            if not rebuild:
+                self._load(stats)
+                return
+            fresh = IdMap(self.paths)
+            fresh._load(stats)
+            for name in ('mal_by_anilist', 'anilist_by_mal', 'mal_by_title', '_title_claims', '_records', '_file_state'):
+                setattr(self, name, getattr(fresh, name))
+
+    def start_refresh_timer(self, interval=ID_MAP_REFRESH_INTERVAL, logger=None):
+        """Refresh every `interval` seconds from a daemon thread, keeping file reads and
+        rebuilds off the request path. Does nothing when no dataset is configured."""
+        if not self.paths or interval <= 0:
+            return None
+
+        def run():
+            while True:
+                time.sleep(interval)
+                try:
+                    self.refresh()
+                except Exception as e:
+                    if logger:
+                        logger.error(f"Id map refresh failed: {e}")
+
+        thread = threading.Thread(target=run, name='id-map-refresh', daemon=True)
+        thread.start()
+        return thread
+
+    def mal_id_for_anilist(self, anilist_id):
+        return self.mal_by_anilist.get(anilist_id) if anilist_id else None
+
+    def anilist_id_for_mal(self, mal_id):
+        return self.anilist_by_mal.get(mal_id) if mal_id else None
+
+    def mal_id_for_title(self, title):
+        return self.mal_by_title.get(normalize_title(title))
+
+ID_MAP = IdMap(ID_MAP_PATHS)
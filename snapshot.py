@@ -0,0 +1,188 @@
+# snapshot.py
+#
+# Persists the in-process caches of GetDiscussionV2 as gzipped JSON so a restarted worker
+# starts warm instead of re-hitting AniList and MAL for every popular show. The snapshot lives
+# in Redis when SNAPSHOT_PATH (or, failing that, REDIS_URL) is a redis:// or rediss:// URL,
+# since a dyno's local disk is wiped on restart; otherwise it is a local file, which only
+# survives gunicorn worker recycles.
+
+import gzip
+import json
+import os
+import threading
+import time
+from urllib.parse import urlsplit
+
+import GetDiscussionV2
+
+SNAPSHOT_PATH = os.getenv('SNAPSHOT_PATH') or os.getenv('REDIS_URL') or 'cache_snapshot.json.gz'
+SNAPSHOT_REDIS_KEY = os.getenv('SNAPSHOT_REDIS_KEY', 'aninex:cache_snapshot')
+SNAPSHOT_INTERVAL = int(os.getenv('SNAPSHOT_INTERVAL', '600'))
+
+# Bump whenever a cache's key/value shape changes; snapshots with another version are discarded.
+SNAPSHOT_VERSION = 2
+
+# name -> (cache dict, its size bound, its TTL, decoder for one JSON (key, value) pair). JSON turns
+# every dict key into a string and tuples into lists, so the decoders restore the in-memory shapes.
+_CACHES = {
+    'nodes': (
+        GetDiscussionV2._NODE_CACHE,
+        GetDiscussionV2._NODE_CACHE_MAX,
+        GetDiscussionV2._NODE_CACHE_TTL,
+        lambda k, v: (int(k), v),
+    ),
+    'episode_pages': (
+        GetDiscussionV2._EPISODE_PAGE_CACHE,
+        GetDiscussionV2._EPISODE_PAGE_CACHE_MAX,
+        GetDiscussionV2._EPISODE_PAGE_CACHE_TTL,
+        lambda k, v: (k, {int(idx): topic for idx, topic in v.items()}),
+    ),
+    'resolved': (
+        GetDiscussionV2._RESOLVED_CACHE,
+        GetDiscussionV2._RESOLVED_CACHE_MAX,
+        GetDiscussionV2._RESOLVED_CACHE_TTL,
+        lambda k, v: (k, tuple(v)),
+    ),
+}
+
+_save_lock = threading.Lock()
+
+def _is_redis_url(path):
+    return path.startswith(('redis://', 'rediss://'))
+
+def describe_location(path=SNAPSHOT_PATH):
+    """`path` safe for logs: Redis URLs are reduced to scheme, host and port."""
+    if not _is_redis_url(path):
+        return path
+    parts = urlsplit(path)
+    return f"{parts.scheme}://{parts.hostname}:{parts.port or 6379}"
+
+def _redis_client(url):
+    import redis
+    # Heroku Redis serves TLS with a self-signed certificate.
+    if url.startswith('rediss://'):
+        return redis.Redis.from_url(url, ssl_cert_reqs=None)
+    return redis.Redis.from_url(url)
+
+def _write_bytes(path, data):
+    if _is_redis_url(path):
+        _redis_client(path).set(SNAPSHOT_REDIS_KEY, data)
+        return
+    tmp_path = f"{path}.{os.getpid()}.tmp"
+    with open(tmp_path, 'wb') as f:
+        f.write(data)
+    os.replace(tmp_path, path)
+
+def _read_bytes(path):
+    """Raw snapshot bytes, or None when there is no snapshot or the store is unreachable."""
+    if _is_redis_url(path):
+        import redis
+        try:
+            return _redis_client(path).get(SNAPSHOT_REDIS_KEY)
+        except redis.RedisError:
+            return None
+    try:
+        with open(path, 'rb') as f:
+            return f.read()
+    except OSError:
+        return None
+
+def _read_payload(path):
+    """The decoded snapshot at `path`, or None if it is missing, unreadable or another version."""
+    data = _read_bytes(path)
+    if not data:
+        return None
+    try:
+        payload = json.loads(gzip.decompress(data))
+    except (OSError, ValueError):
+        return None
+    if not isinstance(payload, dict) or payload.get('version') != SNAPSHOT_VERSION:
+        return None
+    return payload
+
+def _is_fresh(entry, ttl, now):
+    try:
+        stored_at, _ = entry
+        return now - stored_at <= ttl
+    except (TypeError, ValueError):
+        return False
+
+def save_snapshot(path=SNAPSHOT_PATH):
+    """Merge every still-fresh cache entry into the snapshot at `path` (a file or Redis URL)
+    and write it back, atomically replacing the previous one so concurrent workers never read
+    a half-written snapshot. Workers share one snapshot, so entries saved by other workers are
+    kept; on a key clash the more recently stored entry wins, and each cache keeps its newest
+    entries up to its size bound. Entries keep their original `stored_at`, so re-saving never
+    extends their life. Returns the number of entries written."""
+    existing = (_read_payload(path) or {}).get('caches') or {}
+    now = time.time()
+    caches = {}
+    for name, (cache, cache_max, ttl, _) in _CACHES.items():
+        stored = existing.get(name)
+        merged = {
+            key: entry for key, entry in (stored.items() if isinstance(stored, dict) else [])
+            if _is_fresh(entry, ttl, now)
+        }
+        for key, entry in cache.copy().items():
+            if not _is_fresh(entry, ttl, now):
+                continue
+            # JSON keys are strings, so compare against stored entries by their string form.
+            key = str(key)
+            if key not in merged or merged[key][0] < entry[0]:
+                merged[key] = entry
+        newest = sorted(merged.items(), key=lambda item: item[1][0], reverse=True)[:cache_max]
+        caches[name] = dict(newest)
+    payload = {'version': SNAPSHOT_VERSION, 'created_at': now, 'caches': caches}
+    data = gzip.compress(json.dumps(payload, separators=(',', ':')).encode('utf-8'))
+
+    with _save_lock:
+        _write_bytes(path, data)
+    return sum(len(cache) for cache in caches.values())
+
+def load_snapshot(path=SNAPSHOT_PATH):
+    """Merge a snapshot from `path` into the caches, without overwriting anything already
+    cached. Expired entries are skipped, and missing, unreadable or other-version snapshots
+    are ignored. Returns the number of entries loaded."""
+    payload = _read_payload(path)
+    if payload is None:
+        return 0
+
+    now = time.time()
+    loaded = 0
+    for name, entries in (payload.get('caches') or {}).items():
+        if name not in _CACHES:
+            continue
+        cache, cache_max, ttl, decode = _CACHES[name]
+        for raw_key, entry in entries.items():
+            if len(cache) >= cache_max:
+                break
+            try:
+                stored_at, raw_value = entry
+                if now - stored_at > ttl:
+                    continue
+                key, value = decode(raw_key, raw_value)
+            except (TypeError, ValueError, AttributeError):
+                continue
+            if key not in cache:
+                cache[key] = (stored_at, value)
+                loaded += 1
+    return loaded
+
+def start_snapshot_timer(interval=SNAPSHOT_INTERVAL, path=SNAPSHOT_PATH, logger=None):
+    """Save a snapshot every `interval` seconds from a daemon thread. A non-positive
+    interval disables the timer."""
+    if interval <= 0:
+        return None
+
+    def run():
+        while True:
+            time.sleep(interval)
+            try:
+                save_snapshot(path)
+            except Exception as e:
+                if logger:
+                    logger.error(f"Cache snapshot to {describe_location(path)} failed: {e}")
+
+    thread = threading.Thread(target=run, name='cache-snapshot', daemon=True)
+    thread.start()
+    return thread
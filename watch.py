@@ -0,0 +1,177 @@
+# watch.py
+#
+# Live forum threads: one background poller per topic fetches new posts from MAL and fans
+# them out to every subscribed client, so upstream load stays constant per topic no matter
+# how many clients are watching.
+
+import json
+import queue
+import threading
+import time
+
+from flask import current_app
+
+from GetDiscussionV2 import fetch_forum_topic
+
+WATCH_NOT_FOUND = 404
+WATCH_LIMIT_REACHED = 503
+
+# Poll quickly while a thread is getting new posts, backing off towards the max as it cools.
+WATCH_MIN_INTERVAL = 5
+WATCH_MAX_INTERVAL = 120
+WATCH_BACKOFF = 1.5
+# Comment lines sent while idle so proxies (Heroku's router drops after 55s) keep the stream open.
+WATCH_HEARTBEAT = 15
+# How long a poller keeps running after its last subscriber leaves, to absorb reconnects.
+WATCH_IDLE_GRACE = 60
+# Recent posts kept per topic and replayed to new subscribers.
+WATCH_BACKLOG = 100
+# Upper bound on live pollers per worker, so upstream load can't grow with arbitrary topic ids.
+WATCH_MAX_POLLERS = 200
+
+_POLLERS = {}
+# topic id -> _Probe for topics whose first fetch is in flight; guarded by _POLLERS_LOCK too.
+_PROBES = {}
+_POLLERS_LOCK = threading.Lock()
+
+class TopicPoller:
+    """Polls one MAL forum topic and broadcasts each batch of new posts to subscriber queues,
+    skipping posts a subscriber had already seen when it joined. Posts are tracked by their
+    `number`, which is also the SSE event id."""
+
+    def __init__(self, app, topic_id):
+        self.app = app
+        self.topic_id = topic_id
+        self.subscribers = {}
+        self.posts = []
+        self.high_water = 0
+        self.interval = WATCH_MIN_INTERVAL
+        self.idle_since = None
+        self.lock = threading.Lock()
+        self.thread = threading.Thread(target=self._run, name=f'watch-{topic_id}', daemon=True)
+
+    def subscribe(self, last_seen=0):
+        """Register a new subscriber queue, pre-loaded with any backlog posts after `last_seen`."""
+        q = queue.Queue()
+        with self.lock:
+            backlog = [post for post in self.posts if post.get('number', 0) > last_seen]
+            # Queue the backlog before publish() can add a newer batch, keeping event ids in order.
+            if backlog:
+                q.put(backlog)
+            self.subscribers[q] = last_seen
+            self.idle_since = None
+        return q
+
+    def unsubscribe(self, q):
+        with self.lock:
+            self.subscribers.pop(q, None)
+            if not self.subscribers:
+                self.idle_since = time.monotonic()
+
+    def _retire_if_idle(self):
+        with _POLLERS_LOCK, self.lock:
+            if self.subscribers or self.idle_since is None:
+                return False
+            if time.monotonic() - self.idle_since < WATCH_IDLE_GRACE:
+                return False
+            _POLLERS.pop(self.topic_id, None)
+            return True
+
+    def _poll(self):
+        # The HTML scrape fallback returns the whole page holding high_water, so filter by number.
+        try:
+            topic, error = fetch_forum_topic(self.topic_id, offset=self.high_water)
+        except Exception as e:
+            current_app.logger.error(f"Watch poll failed for topic {self.topic_id}: {e}")
+            return []
+        if topic is None:
+            return []
+        return [post for post in topic.get('posts', []) if post.get('number', 0) > self.high_water]
+
+    def publish(self, new_posts):
+        """Record a batch of new posts and hand each subscriber the ones it hasn't seen."""
+        with self.lock:
+            self.high_water = max(post.get('number', 0) for post in new_posts)
+            self.posts = (self.posts + new_posts)[-WATCH_BACKLOG:]
+            for q, last_seen in self.subscribers.items():
+                batch = [post for post in new_posts if post.get('number', 0) > last_seen]
+                if batch:
+                    q.put(batch)
+
+    def _run(self):
+        with self.app.app_context():
+            while True:
+                time.sleep(self.interval)
+                if self._retire_if_idle():
+                    return
+                new_posts = self._poll()
+                if new_posts:
+                    self.publish(new_posts)
+                    self.interval = WATCH_MIN_INTERVAL
+                else:
+                    self.interval = min(self.interval * WATCH_BACKOFF, WATCH_MAX_INTERVAL)
+
+class _Probe:
+    """A first-page fetch in flight for a topic with no poller yet. Concurrent first watchers
+    wait on it instead of each fetching the topic themselves."""
+
+    def __init__(self):
+        self.done = threading.Event()
+        self.error = None
+
+def subscribe(app, topic_id, last_seen=0):
+    """Subscribe to a topic, starting its poller if none is running. A poller is only started
+    for a topic whose first posts can be fetched, and only while this worker runs fewer than
+    WATCH_MAX_POLLERS. Returns (poller, queue, error) where error is None, WATCH_NOT_FOUND or
+    WATCH_LIMIT_REACHED; poller and queue are None on error."""
+    with _POLLERS_LOCK:
+        poller = _POLLERS.get(topic_id)
+        if poller is not None:
+            return poller, poller.subscribe(last_seen), None
+        probe = _PROBES.get(topic_id)
+        if probe is None:
+            # Probes count towards the cap, since each becomes a poller if it succeeds.
+            if len(_POLLERS) + len(_PROBES) >= WATCH_MAX_POLLERS:
+                return None, None, WATCH_LIMIT_REACHED
+            probe = _PROBES[topic_id] = _Probe()
+            owner = True
+        else:
+            owner = False
+
+    if not owner:
+        probe.done.wait()
+        if probe.error is not None:
+            return None, None, probe.error
+        return subscribe(app, topic_id, last_seen)
+
+    # Probe the topic outside the lock; the first page also seeds the new poller.
+    try:
+        try:
+            topic, _ = fetch_forum_topic(topic_id)
+        except Exception as e:
+            current_app.logger.error(f"Watch probe failed for topic {topic_id}: {e}")
+            topic = None
+
+        with _POLLERS_LOCK:
+            del _PROBES[topic_id]
+            if not topic or not topic.get('posts'):
+                probe.error = WATCH_NOT_FOUND
+                return None, None, WATCH_NOT_FOUND
+            poller = _POLLERS[topic_id] = TopicPoller(app, topic_id)
+            poller.publish(topic['posts'])
+            poller.thread.start()
+            return poller, poller.subscribe(last_seen), None
+    finally:
+        probe.done.set()
+
+def stream_topic(q):
+    """Server-Sent Events stream of a subscriber queue: one `posts` event per batch, with the
+    batch's highest post number as the event id so reconnecting clients resume from it."""
+    yield f"retry: {WATCH_MIN_INTERVAL * 1000}\n\n"
+    while True:
+        try:
+            posts = q.get(timeout=WATCH_HEARTBEAT)
+        except queue.Empty:
+            yield ": keep-alive\n\n"
+            continue
+        yield f"id: {posts[-1].get('number', 0)}\nevent: posts\ndata: {json.dumps(posts)}\n\n"